@@ -1,4 +1,10 @@
+import concurrent.futures
+import copy
+import functools
+import hashlib
 import json
+import os
+import tempfile
 import typing
 
 import python_minifier
@@ -9,10 +15,43 @@ import troposphere.events
 import troposphere.logs
 import troposphere.rds
 import troposphere.stepfunctions
+import yaml
 
-from iam import add_lambda_role, HANDLER_POLICIES, add_fargate_task_execution_role, add_state_machine_role, \
+try:
+    from importlib.metadata import version as package_version
+except ImportError:
+    # python 3.7
+    from importlib_metadata import version as package_version
+
+try:
+    import orjson
+except ImportError:
+    # optional, only used to serialize the state machine definition faster
+    orjson = None
+
+from iam import add_lambda_role, get_handler_policies, add_fargate_task_execution_role, add_state_machine_role, \
     add_cloudwatch_role
 
+_REPR_REGISTERED = False
+
+HANDLER_SOURCE = "lambda/rds.py"
+CACHE_DIR = ".cache"
+
+# every transform that makes the handler smaller; MINIFY_LEVEL=0 turns them off for debugging the deployed code
+MINIFY_TRANSFORMS = [
+    "remove_literal_statements",
+    "hoist_literals",
+    "combine_imports",
+    "rename_locals",
+    "remove_annotations",
+    "remove_object_base",
+    "convert_posargs_to_args",
+    "remove_asserts",
+    "remove_debug",
+    "remove_explicit_return_none",
+    "constant_folding",
+]
+
 
 def add_parameter(template: troposphere.Template, title: str, label: str, group: str, **kwargs):
     p = troposphere.Parameter(
@@ -25,9 +64,10 @@ def add_parameter(template: troposphere.Template, title: str, label: str, group:
     return p
 
 
-def add_lambda(template: troposphere.Template, name: str, code: str, policies, **kwargs):
+def add_lambda(template: troposphere.Template, name: str, code: str, policies,
+               runtime: typing.Union[str, troposphere.AWSHelperFn] = "python3.12", **kwargs):
     func = troposphere.awslambda.Function(f"{name}Function", template, **kwargs)
-    func.Runtime = "python3.7"
+    func.Runtime = runtime
     func.Code = troposphere.awslambda.Code(ZipFile=code)
     func.Handler = "index.handler"
     func.Role = add_lambda_role(template, name, policies).get_att("Arn")
@@ -35,21 +75,48 @@ def add_lambda(template: troposphere.Template, name: str, code: str, policies, *
     return func
 
 
-def add_state_machine_handler(template: troposphere.Template):
-    # minify so it fits in 4096 bytes and we don't need to upload to S3 first
+def _minify_options() -> typing.Dict[str, bool]:
+    full = os.environ.get("MINIFY_LEVEL", "1") != "0"
+    return {transform: full for transform in MINIFY_TRANSFORMS}
+
+
+def _minified_handler(refresh_cache: bool = False) -> str:
+    source = open(HANDLER_SOURCE).read()
+    options = _minify_options()
+    # a different minifier version can produce different output for the same source and options
+    minifier_version = package_version("python-minifier")
+    key = hashlib.sha256((source + json.dumps(options, sort_keys=True) + minifier_version).encode()).hexdigest()
+    cache_path = os.path.join(CACHE_DIR, f"handler.{key}.py")
+
+    if not refresh_cache and os.path.exists(cache_path):
+        return open(cache_path).read()
+
+    # minify so the inline code keeps the template small and we don't need to upload to S3 first
     code = python_minifier.minify(
-        open("lambda/rds.py").read(),
-        "lambda/rds.py",
+        source,
+        HANDLER_SOURCE,
         rename_globals=True,
-        preserve_globals=["handler", "NotReady"]
+        preserve_globals=["handler"],
+        **options
     )
 
+    # write and rename so an interrupted run never leaves a partial cache entry behind
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=CACHE_DIR, delete=False) as f:
+        f.write(code)
+    os.replace(f.name, cache_path)
+
+    return code
+
+
+def add_state_machine_handler(template: troposphere.Template, code: str):
     return add_lambda(
         template,
         "Handler",
         code,
-        HANDLER_POLICIES,
-        Timeout=30,
+        get_handler_policies(),
+        runtime=troposphere.Ref("LambdaRuntime"),
+        Timeout=330,  # waiting states block on RDS waiters for up to ~5 minutes
     )
 
 
@@ -79,26 +146,36 @@ def add_fargate_cluster(template: troposphere.Template) -> troposphere.ecs.Clust
     )
 
 
-def add_fargate_task_definition(template: troposphere.Template) -> typing.Dict[str, troposphere.ecs.TaskDefinition]:
+def add_fargate_task_definition(template: troposphere.Template) \
+        -> typing.List[typing.Tuple[str, str, troposphere.ecs.TaskDefinition]]:
     log_group = troposphere.logs.LogGroup("SanitizerLogs", template)
     role = add_fargate_task_execution_role(template)
 
-    return {
-        engine: troposphere.ecs.TaskDefinition(
-            f"{engine.title()}SanitizerTask", template,
+    # identical for every engine, so build it once and share it between the container definitions
+    log_configuration = troposphere.ecs.LogConfiguration(
+        LogDriver="awslogs",
+        Options={
+            "awslogs-group": log_group.ref(),
+            "awslogs-region": troposphere.Region,
+            "awslogs-stream-prefix": "sql",
+        }
+    )
+
+    # (RDS engine, name used in resource and state titles, sanitizing command)
+    tasks = []
+    for engine, name, cmd in (
+            ("postgres", "Postgres", ["psql", "-c", troposphere.Ref("SanitizeSQL")]),
+            ("mysql", "MySQL", ["mysql", "-e", troposphere.Ref("SanitizeSQL")]),
+            ("mariadb", "MariaDB", ["mysql", "-e", troposphere.Ref("SanitizeSQL")]),
+    ):
+        task = troposphere.ecs.TaskDefinition(
+            f"{name}SanitizerTask", template,
             ContainerDefinitions=[
                 troposphere.ecs.ContainerDefinition(
                     Name="sql",
                     Image=engine,
                     Command=cmd,
-                    LogConfiguration=troposphere.ecs.LogConfiguration(
-                        LogDriver="awslogs",
-                        Options={
-                            "awslogs-group": log_group.ref(),
-                            "awslogs-region": troposphere.Region,
-                            "awslogs-stream-prefix": "sql",
-                        }
-                    )
+                    LogConfiguration=log_configuration,
                 ),
             ],
             Cpu="512",
@@ -107,18 +184,125 @@ def add_fargate_task_definition(template: troposphere.Template) -> typing.Dict[s
             RequiresCompatibilities=["FARGATE"],
             ExecutionRoleArn=role.get_att("Arn"),
         )
-        for engine, cmd in {
-            "postgres": ["psql", "-c", troposphere.Ref("SanitizeSQL")],
-            "mysql": ["mysql", "-e", troposphere.Ref("SanitizeSQL")],
-            "mariadb": ["mysql", "-e", troposphere.Ref("SanitizeSQL")],
-        }.items()
-    }
+        tasks.append((engine, name, task))
+
+    return tasks
+
+
+# connection details for psql and mysql, taken from the state set by SetTempPassword
+SANITIZER_ENVIRONMENT = [
+    {
+        "Name": "PGHOST",
+        "Value.$": "$.db.host",
+    },
+    {
+        "Name": "PGPORT",
+        "Value.$": "$.db.port",
+    },
+    {
+        "Name": "PGUSER",
+        "Value.$": "$.db.user",
+    },
+    {
+        "Name": "PGPASSWORD",
+        "Value.$": "$.db.password",
+    },
+    {
+        "Name": "PGDATABASE",
+        "Value.$": "$.db.database",
+    },
+    {
+        "Name": "PGCONNECT_TIMEOUT",
+        "Value": "30",
+    },
+    {
+        "Name": "MYSQL_HOST",
+        "Value.$": "$.db.host",
+    },
+    {
+        "Name": "MYSQL_PORT",
+        "Value.$": "$.db.port",
+    },
+    {
+        "Name": "MYSQL_USER",
+        "Value.$": "$.db.user",
+    },
+    {
+        "Name": "MYSQL_PASSWORD",
+        "Value.$": "$.db.password",
+    },
+    {
+        "Name": "MYSQL_DATABASE",
+        "Value.$": "$.db.database",
+    },
+]
+
+
+# time between polls of a waiting state, the handler itself waits up to 5 minutes per poll
+WAIT_DELAY_SECONDS = 60
+# retry policy shared by both cleanup states
+CLEANUP_RETRY = {
+    "ErrorEquals": ["States.ALL"],
+    "IntervalSeconds": 120,
+    "MaxAttempts": 10,
+}
+# states that create or change resources re-run after failures in Lambda itself, the handler skips work an earlier
+# attempt already finished
+MUTATE_RETRY = {
+    "ErrorEquals": [
+        "Lambda.ServiceException",
+        "Lambda.AWSLambdaException",
+        "Lambda.SdkClientException",
+        "Lambda.TooManyRequestsException",
+        "Sandbox.Timedout",
+        "States.Timeout",
+    ],
+    "IntervalSeconds": 10,
+    "MaxAttempts": 3,
+    "BackoffRate": 2,
+}
+
+
+@functools.lru_cache()
+def _catch_all(catch_state: str) -> typing.List[dict]:
+    return [
+        {
+            "ErrorEquals": ["States.ALL"],
+            "Next": catch_state,
+        }
+    ]
+
+
+def _sub(name: str, attr: str = "") -> str:
+    # placeholder resolved through DefinitionSubstitutions
+    return f"${{{name}{attr}}}"
+
+
+def _dump_definition(definition: dict, pretty: bool) -> str:
+    # Step Functions doesn't care about whitespace, so only pay for it when someone wants to read the template
+    if orjson:
+        return orjson.dumps(definition, option=orjson.OPT_INDENT_2 if pretty else 0).decode()
+    # like orjson, leave non-ASCII text alone instead of escaping it
+    return json.dumps(definition, ensure_ascii=False, **({"indent": 2} if pretty else {"separators": (",", ":")}))
 
 
 def add_state_machine(template, function: troposphere.awslambda.Function, cluster: troposphere.ecs.Cluster,
-                      tasks: typing.Dict[str, troposphere.ecs.TaskDefinition]):
-    fn_arn_sub = "${" + function.title + ".Arn}"
-    cluster_arn_sub = "${" + cluster.title + "}"
+                      tasks: typing.List[typing.Tuple[str, str, troposphere.ecs.TaskDefinition]],
+                      pretty: bool = False):
+    fn_arn_sub = _sub(function.title, "Arn")
+    cluster_arn_sub = _sub(cluster.title)
+
+    # resolved by Step Functions when the state machine is created, instead of running Fn::Sub over the definition
+    substitutions = {
+        function.title + "Arn": function.get_att("Arn"),
+        cluster.title: cluster.ref(),
+        "SubnetIdsJoined": troposphere.Join('", "', troposphere.Ref("SubnetIds")),
+        "ShareAccountsJoined": troposphere.Join('", "', troposphere.Ref("ShareAccounts")),
+    }
+    for name in ["Db", "VpcId", "SubnetGroup", "SecurityGroup", "NewSnapshot", "SnapshotFormat", "KMS"]:
+        substitutions[name] = troposphere.Ref(name)
+    for _, _, task in tasks:
+        substitutions[task.title] = task.ref()
 
     states = {
         "Success": {
@@ -129,7 +313,8 @@ def add_state_machine(template, function: troposphere.awslambda.Function, cluste
         }
     }
 
-    def add_state(state_name: str, next_state_name: str, catch_state: str = None, retry=None):
+    def add_state(state_name: str, next_state_name: str, catch_state: typing.Optional[str] = "ErrorCleanup",
+                  retry=None):
         states[state_name] = {
             "Type": "Task",
             "Resource": fn_arn_sub,
@@ -141,110 +326,33 @@ def add_state_machine(template, function: troposphere.awslambda.Function, cluste
             "Next": next_state_name,
         }
 
-        if catch_state:
-            states[state_name]["Catch"] = [
-                {
-                    "ErrorEquals": ["States.ALL"],
-                    "Next": catch_state,
-                }
-            ]
+        if catch_state is not None:
+            states[state_name]["Catch"] = _catch_all(catch_state)
 
         if retry:
             states[state_name]["Retry"] = [retry]
 
-    def add_waiting_state(state_name: str, next_state_name: str, catch_state: str = None):
-        add_state(state_name, next_state_name, catch_state=catch_state, retry={
-            "ErrorEquals": ["NotReady"],
-            "IntervalSeconds": 60,
-            "MaxAttempts": 300,  # 5 hours max wait time
-            "BackoffRate": 1,
-        })
-
-    def add_task_state(state_name: str, task_arn: str, next_state_name: str, catch_state: str = None):
-        states[state_name] = {
-            "Type": "Task",
-            "Resource": "arn:aws:states:::ecs:runTask.sync",
-            "OutputPath": "$",
-            "ResultPath": "$.SanitizeResult",
-            "Parameters": {
-                "TaskDefinition": task_arn,
-                "Cluster": cluster_arn_sub,
-                "LaunchType": "FARGATE",
-                "NetworkConfiguration": {
-                    "AwsvpcConfiguration": {
-                        "AssignPublicIp": "ENABLED",  # TODO what about subnets with no public facing IP?
-                        "SecurityGroups": [
-                            "${SecurityGroup}",
-                        ],
-                        "Subnets": [
-                            "${SubnetIdsJoined}",
-                        ],
-                    }
+    def add_waiting_state(state_name: str, next_state_name: str, catch_state: typing.Optional[str] = "ErrorCleanup"):
+        # the handler reports readiness in $.ready, so loop through a wait until it's set instead of retrying errors
+        add_state(state_name, f"{state_name}Check", catch_state=catch_state)
+        states[f"{state_name}Check"] = {
+            "Type": "Choice",
+            "Choices": [
+                {
+                    "Variable": "$.ready",
+                    "BooleanEquals": True,
+                    "Next": next_state_name,
                 },
-                "Overrides": {
-                    "ContainerOverrides": [{
-                        "Name": "sql",
-                        "Environment": [
-                            {
-                                "Name": "PGHOST",
-                                "Value.$": "$.db.host",
-                            },
-                            {
-                                "Name": "PGPORT",
-                                "Value.$": "$.db.port",
-                            },
-                            {
-                                "Name": "PGUSER",
-                                "Value.$": "$.db.user",
-                            },
-                            {
-                                "Name": "PGPASSWORD",
-                                "Value.$": "$.db.password",
-                            },
-                            {
-                                "Name": "PGDATABASE",
-                                "Value.$": "$.db.database",
-                            },
-                            {
-                                "Name": "PGCONNECT_TIMEOUT",
-                                "Value": "30",
-                            },
-                            {
-                                "Name": "MYSQL_HOST",
-                                "Value.$": "$.db.host",
-                            },
-                            {
-                                "Name": "MYSQL_PORT",
-                                "Value.$": "$.db.port",
-                            },
-                            {
-                                "Name": "MYSQL_USER",
-                                "Value.$": "$.db.user",
-                            },
-                            {
-                                "Name": "MYSQL_PASSWORD",
-                                "Value.$": "$.db.password",
-                            },
-                            {
-                                "Name": "MYSQL_DATABASE",
-                                "Value.$": "$.db.database",
-                            },
-                        ]
-                    }],
-                }
-            },
-            "Next": next_state_name,
+            ],
+            "Default": f"{state_name}Delay",
+        }
+        states[f"{state_name}Delay"] = {
+            "Type": "Wait",
+            "Seconds": WAIT_DELAY_SECONDS,
+            "Next": state_name,
         }
 
-        if catch_state:
-            states[state_name]["Catch"] = [
-                {
-                    "ErrorEquals": ["States.ALL"],
-                    "Next": catch_state,
-                }
-            ]
-
-    add_state("Initialize", "ChooseSnapshot", catch_state="ErrorCleanup")
+    add_state("Initialize", "ChooseSnapshot")
     del states["Initialize"]["Parameters"]["state.$"]
     states["Initialize"]["Parameters"]["state"] = {
         "db_identifier": "${Db}",
@@ -275,9 +383,9 @@ def add_state_machine(template, function: troposphere.awslambda.Function, cluste
         "Default": "ErrorCleanup",
     }
 
-    add_state("TakeSnapshot", "WaitForSnapshot", catch_state="ErrorCleanup")
-    add_waiting_state("WaitForSnapshot", "ShouldEncrypt", catch_state="ErrorCleanup")
-    add_state("FindLatestSnapshot", "ShouldEncrypt", catch_state="ErrorCleanup")
+    add_state("TakeSnapshot", "WaitForSnapshot", retry=MUTATE_RETRY)
+    add_waiting_state("WaitForSnapshot", "ShouldEncrypt")
+    add_state("FindLatestSnapshot", "ShouldEncrypt")
 
     states["ShouldEncrypt"] = {
         "Type": "Choice",
@@ -291,73 +399,84 @@ def add_state_machine(template, function: troposphere.awslambda.Function, cluste
         "Default": "Encrypt",
     }
 
-    add_state("Encrypt", "WaitForEncrypt", catch_state="ErrorCleanup")
-    add_waiting_state("WaitForEncrypt", "CreateTempDatabase", catch_state="ErrorCleanup")
+    add_state("Encrypt", "WaitForEncrypt", retry=MUTATE_RETRY)
+    add_waiting_state("WaitForEncrypt", "CreateTempDatabase")
 
-    add_state("CreateTempDatabase", "WaitForTempDatabase", catch_state="ErrorCleanup")
-    add_waiting_state("WaitForTempDatabase", "SetTempPassword", catch_state="ErrorCleanup")
-    add_state("SetTempPassword", "WaitForPassword", catch_state="ErrorCleanup")
-    add_waiting_state("WaitForPassword", "ChooseSanitizer", catch_state="ErrorCleanup")
+    add_state("CreateTempDatabase", "WaitForTempDatabase", retry=MUTATE_RETRY)
+    add_waiting_state("WaitForTempDatabase", "SetTempPassword")
+    add_state("SetTempPassword", "WaitForPassword")
+    add_waiting_state("WaitForPassword", "ChooseSanitizer")
 
     states["ChooseSanitizer"] = {
         "Type": "Choice",
         "Choices": [
             {
                 "Variable": "$.engine",
-                "StringEquals": "postgres",
-                "Next": "SanitizePostgres",
-            },
-            {
-                "Variable": "$.engine",
-                "StringEquals": "mysql",
-                "Next": "SanitizeMySQL",
-            },
-            {
-                "Variable": "$.engine",
-                "StringEquals": "mariadb",
-                "Next": "SanitizeMariaDB",
-            },
+                "StringEquals": engine,
+                "Next": f"Sanitize{name}",
+            }
+            for engine, name, _ in tasks
         ],
         "Default": "ErrorCleanup",
     }
 
-    for engine in ["Postgres", "MySQL", "MariaDB"]:
-        add_task_state(f"Sanitize{engine}", "${" + tasks[engine.lower()].title + "}", "TakeFinalSnapshot",
-                       catch_state="ErrorCleanup")
+    # sanitizing states only differ by task definition, so build one and copy it for each engine
+    task_state = {
+        "Type": "Task",
+        "Resource": "arn:aws:states:::ecs:runTask.sync",
+        "OutputPath": "$",
+        "ResultPath": "$.SanitizeResult",
+        "Parameters": {
+            "TaskDefinition": None,
+            "Cluster": cluster_arn_sub,
+            "LaunchType": "FARGATE",
+            "NetworkConfiguration": {
+                "AwsvpcConfiguration": {
+                    "AssignPublicIp": "ENABLED",  # TODO what about subnets with no public facing IP?
+                    "SecurityGroups": [
+                        "${SecurityGroup}",
+                    ],
+                    "Subnets": [
+                        "${SubnetIdsJoined}",
+                    ],
+                }
+            },
+            "Overrides": {
+                "ContainerOverrides": [{
+                    "Name": "sql",
+                    "Environment": SANITIZER_ENVIRONMENT,
+                }],
+            }
+        },
+        "Next": "TakeFinalSnapshot",
+        "Catch": _catch_all("ErrorCleanup"),
+    }
+    shared = {id(SANITIZER_ENVIRONMENT): SANITIZER_ENVIRONMENT, id(task_state["Catch"]): task_state["Catch"]}
+
+    for _, name, task in tasks:
+        states[f"Sanitize{name}"] = copy.deepcopy(task_state, dict(shared))
+        states[f"Sanitize{name}"]["Parameters"]["TaskDefinition"] = _sub(task.title)
 
-    add_state("TakeFinalSnapshot", "WaitForFinalSnapshot", catch_state="ErrorCleanup")
-    add_waiting_state("WaitForFinalSnapshot", "ShareSnapshot", catch_state="ErrorCleanup")
+    add_state("TakeFinalSnapshot", "WaitForFinalSnapshot", retry=MUTATE_RETRY)
+    add_waiting_state("WaitForFinalSnapshot", "ShareSnapshot")
 
-    add_state("ShareSnapshot", "Cleanup", catch_state="ErrorCleanup")
+    add_state("ShareSnapshot", "Cleanup", retry=MUTATE_RETRY)
 
-    add_state("Cleanup", "Success", retry={
-        "ErrorEquals": ["States.ALL"],
-        "IntervalSeconds": 120,
-        "MaxAttempts": 10,
-    })
+    add_state("Cleanup", "Success", catch_state=None, retry=CLEANUP_RETRY)
 
-    add_state("ErrorCleanup", "Failure", retry={
-        "ErrorEquals": ["States.ALL"],
-        "IntervalSeconds": 120,
-        "MaxAttempts": 10,
-    })
+    add_state("ErrorCleanup", "Failure", catch_state=None, retry=CLEANUP_RETRY)
 
     state_machine = troposphere.stepfunctions.StateMachine(
         "SnapshotSanitizeAndCopy", template,
-        DefinitionString=troposphere.Sub(
-            json.dumps(
-                {
-                    "StartAt": "Initialize",
-                    "States": states
-                },
-                indent=2
-            ),
+        DefinitionString=_dump_definition(
             {
-                "SubnetIdsJoined": troposphere.Join('", "', troposphere.Ref("SubnetIds")),
-                "ShareAccountsJoined": troposphere.Join('", "', troposphere.Ref("ShareAccounts")),
-            }
+                "StartAt": "Initialize",
+                "States": states
+            },
+            pretty
         ),
-        RoleArn=add_state_machine_role(template, function, tasks.values()).get_att("Arn"),
+        DefinitionSubstitutions=substitutions,
+        RoleArn=add_state_machine_role(template, function, [task for _, _, task in tasks]).get_att("Arn"),
     )
 
     return state_machine
@@ -378,7 +497,13 @@ def add_schedule(template: troposphere.Template, state_machine: troposphere.step
     )
 
 
-def generate_main_template():
+@functools.lru_cache(maxsize=1)
+def generate_main_template(refresh_cache: bool = False, pretty: bool = False) -> troposphere.Template:
+    # minifying the handler is the slowest step, so run it while the rest of the template is assembled
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    handler_code = executor.submit(_minified_handler, refresh_cache)
+    executor.shutdown(wait=False)
+
     template = troposphere.Template("Sanitize and copy latest RDS snapshot to a different account")
 
     add_parameter(template, "Db", "Source database identifier", "Database", Type="String")
@@ -394,6 +519,9 @@ def generate_main_template():
                   "Options", Type="String", Default="{database_identifier:.42}-sanitized-{date:%Y-%m-%d}")
     add_parameter(template, "KMS", "KMS key id to re-encrypt snapshots (leave empty to not encrypt)",
                   "Options", Type="String", Default="")
+    add_parameter(template, "LambdaRuntime", "Python runtime for the state machine handler", "Options",
+                  Type="String", AllowedValues=["python3.10", "python3.11", "python3.12", "python3.13"],
+                  Default="python3.12")
     add_parameter(template, "VpcId", "VPC for temporary database", "Network", Type="AWS::EC2::VPC::Id")
     add_parameter(template, "SubnetIds", "Subnets for temporary database (at least two)", "Network",
                   Type="List<AWS::EC2::Subnet::Id>")
@@ -412,9 +540,9 @@ def generate_main_template():
         SubnetIds=troposphere.Ref("SubnetIds"),
     )
 
-    function = add_state_machine_handler(template)
     cluster = add_fargate_cluster(template)
     tasks = add_fargate_task_definition(template)
+    function = add_state_machine_handler(template, handler_code.result())
     # TODO try to remove public ip with 137112412989.dkr.ecr.us-east-1.amazonaws.com/amazonlinux:latest
     # TODO still requires VPC Endpoint...
     # https://docs.aws.amazon.com/AmazonECR/latest/userguide/vpc-endpoints.html
@@ -428,7 +556,26 @@ def generate_main_template():
     #         "psql", "-c", troposphere.Ref("SanitizeSQL")
     #     ]
     # )
-    state_machine = add_state_machine(template, function, cluster, tasks)
+    state_machine = add_state_machine(template, function, cluster, tasks, pretty)
     add_schedule(template, state_machine)
 
-    return template.to_yaml(clean_up=True, long_form=True)
+    return template
+
+
+def generate_main_template_dict(refresh_cache: bool = False, pretty: bool = False) -> dict:
+    return generate_main_template(refresh_cache, pretty).to_dict()
+
+
+def _literal_unicode_representer(dumper, data):
+    return dumper.represent_scalar(u'tag:yaml.org,2002:str', data, style='|')
+
+
+def generate_main_template_yaml(refresh_cache: bool = False, pretty: bool = False) -> str:
+    global _REPR_REGISTERED
+
+    # only touch the global PyYAML registry when YAML is actually emitted
+    if not _REPR_REGISTERED:
+        yaml.add_representer(troposphere.Sub, _literal_unicode_representer)
+        _REPR_REGISTERED = True
+
+    return generate_main_template(refresh_cache, pretty).to_yaml(clean_up=True, long_form=True)
@@ -1,22 +1,40 @@
+import json
+
 import boto3
 import botocore.exceptions
 import click
-import troposphere.stepfunctions
-import yaml
 
-from cfm import generate_main_template
+from cfm import generate_main_template, generate_main_template_dict, generate_main_template_yaml
 
 
-def _stack_exists(cf, name):
+def _describe_stack(cf, name):
     try:
-        cf.describe_stacks(StackName=name)
-        return True
+        return cf.describe_stacks(StackName=name)["Stacks"][0]
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == 'ValidationError':
-            return False
+            return None
         raise
 
 
+def _stack_up_to_date(cf, stack, stack_template, parameters):
+    deployed_template = cf.get_template(StackName=stack["StackId"])["TemplateBody"]
+    if not isinstance(deployed_template, str):
+        # botocore decodes JSON template bodies, so encode it back the same way we encoded ours
+        deployed_template = json.dumps(deployed_template, sort_keys=True, separators=(",", ":"))
+    if deployed_template != stack_template:
+        return False
+
+    # parameters we don't pass fall back to their defaults on update, so compare against those too
+    wanted_parameters = {
+        key: value.get("Default")
+        for key, value in json.loads(stack_template)["Parameters"].items()
+    }
+    wanted_parameters.update({p["ParameterKey"]: p["ParameterValue"] for p in parameters})
+    deployed_parameters = {p["ParameterKey"]: p["ParameterValue"] for p in stack.get("Parameters", [])}
+
+    return wanted_parameters == deployed_parameters
+
+
 @click.group()
 def cli():
     pass
@@ -24,8 +42,14 @@ def cli():
 
 @click.command()
 @click.option("--output", default="dist/RDS-sanitized-snapshots.yml", help="Template output file", type=click.File("w"))
-def gen(output):
-    output.write(generate_main_template())
+@click.option("--refresh-cache", help="Minify the Lambda handler again even if a cached copy exists", is_flag=True)
+@click.option("--pretty", help="Indent the state machine definition for human inspection", is_flag=True)
+def gen(output, refresh_cache, pretty):
+    if output.name.endswith(".json"):
+        # stream straight into the file instead of building the whole string first
+        json.dump(generate_main_template_dict(refresh_cache, pretty), output, separators=(",", ":"))
+    else:
+        output.write(generate_main_template_yaml(refresh_cache, pretty))
 
 
 def validate_subnets(ctx, param, value):
@@ -46,9 +70,12 @@ def validate_subnets(ctx, param, value):
 @click.option("--new-snapshot", help="Take a new snapshot instead of using the latest available", is_flag=True)
 @click.option("--snapshot_format", help="Snapshot name snapshot_format")
 @click.option("--kms", help="KMS ARN to encrypt snapshots")
-def deploy(profile, stack_name, database, vpc, subnet, sql, share_account, new_snapshot, snapshot_format, kms):
+@click.option("--refresh-cache", help="Minify the Lambda handler again even if a cached copy exists", is_flag=True)
+def deploy(profile, stack_name, database, vpc, subnet, sql, share_account, new_snapshot, snapshot_format, kms,
+           refresh_cache):
     # this is more for testing and not really for user consumption...
-    stack_template = generate_main_template()
+    # CloudFormation only parses this, so send compact JSON instead of the readable YAML `gen` writes
+    stack_template = generate_main_template(refresh_cache).to_json(indent=None, separators=(",", ":"))
 
     if profile:
         session = boto3.Session(profile_name=profile)
@@ -96,7 +123,12 @@ def deploy(profile, stack_name, database, vpc, subnet, sql, share_account, new_s
             "ParameterValue": kms,
         })
 
-    if _stack_exists(cf, stack_name):
+    stack = _describe_stack(cf, stack_name)
+    if stack:
+        if _stack_up_to_date(cf, stack, stack_template, parameters):
+            print("Stack already up-to-date")
+            return
+
         click.echo("Updating stack")
         try:
             cf.update_stack(
@@ -130,10 +162,4 @@ cli.add_command(gen)
 cli.add_command(deploy)
 
 if __name__ == "__main__":
-    def literal_unicode_representer(dumper, data):
-        return dumper.represent_scalar(u'tag:yaml.org,2002:str', data, style='|')
-
-
-    yaml.add_representer(troposphere.Sub, literal_unicode_representer)
-
     cli()
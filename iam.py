@@ -1,3 +1,4 @@
+import functools
 import typing
 
 import troposphere.awslambda
@@ -5,92 +6,97 @@ import troposphere.ecs
 import troposphere.iam
 import troposphere.stepfunctions
 
-HANDLER_POLICIES = [
-    troposphere.iam.Policy(
-        PolicyName="RDS",
-        PolicyDocument={
-            "Version": "2012-10-17",
-            "Statement": [
-                {
-                    "Sid": "OriginalDB",
-                    "Effect": "Allow",
-                    "Action": [
-                        troposphere.If("KmsEmpty", troposphere.NoValue, "rds:CopyDBSnapshot"),
-                        "rds:DescribeDBInstances",
-                        "rds:DescribeDBSnapshots",
-                        "rds:CreateDBSnapshot",
-                        "rds:AddTagsToResource",
-                    ],
-                    "Resource": [
-                        troposphere.Sub(
-                            "arn:${AWS::Partition}:rds:${AWS::Region}:${AWS::AccountId}:db:${Db}"),
-                        # TODO only allow access to all snapshots when using latest snapshot option
-                        troposphere.Sub(
-                            "arn:${AWS::Partition}:rds:${AWS::Region}:${AWS::AccountId}:snapshot:*"),
-                    ]
-                },
-                {
-                    "Sid": "Snapshot",
-                    "Effect": "Allow",
-                    "Action": "rds:RestoreDBInstanceFromDBSnapshot",
-                    "Resource": "*",
-                    "Condition": {
-                        "StringEquals": {
-                            "rds:req-tag/RDS-sanitized-snapshots": "yes",
-                        }
-                    }
-                },
-                {
-                    "Sid": "TempDB",
-                    "Effect": "Allow",
-                    "Action": [
-                        "rds:CreateDBInstance",
-                        "rds:DeleteDBInstance",
-                        "rds:DescribeDBInstances",
-                        "rds:ModifyDBInstance",
-                        "rds:CreateDBSnapshot",
-                        "rds:DeleteDBSnapshot",
-                        "rds:ModifyDBSnapshotAttribute",
-                    ],
-                    "Resource": "*",
-                    "Condition": {
-                        "ForAllValues:StringEquals": {
-                            "aws:TagKeys": [
-                                "RDS-sanitized-snapshots"
-                            ]
-                        }
-                    }
-                },
-                {
-                    "Sid": "Cleanup",
-                    "Effect": "Allow",
-                    "Action": "tag:GetResources",
-                    "Resource": "*",
-                    "Condition": {
-                        "ForAllValues:StringEquals": {
-                            "aws:TagKeys": [
-                                "RDS-sanitized-snapshots-temp",
-                            ]
+
+# built on first use (and only once) so importing this module stays cheap
+@functools.lru_cache(maxsize=None)
+def get_handler_policies() -> typing.List[troposphere.iam.Policy]:
+    return [
+        troposphere.iam.Policy(
+            PolicyName="RDS",
+            PolicyDocument={
+                "Version": "2012-10-17",
+                "Statement": [
+                    {
+                        "Sid": "OriginalDB",
+                        "Effect": "Allow",
+                        "Action": [
+                            troposphere.If("KmsEmpty", troposphere.NoValue, "rds:CopyDBSnapshot"),
+                            "rds:DescribeDBInstances",
+                            "rds:DescribeDBSnapshots",
+                            "rds:DescribeDBSnapshotAttributes",
+                            "rds:CreateDBSnapshot",
+                            "rds:AddTagsToResource",
+                        ],
+                        "Resource": [
+                            troposphere.Sub(
+                                "arn:${AWS::Partition}:rds:${AWS::Region}:${AWS::AccountId}:db:${Db}"),
+                            # TODO only allow access to all snapshots when using latest snapshot option
+                            troposphere.Sub(
+                                "arn:${AWS::Partition}:rds:${AWS::Region}:${AWS::AccountId}:snapshot:*"),
+                        ]
+                    },
+                    {
+                        "Sid": "Snapshot",
+                        "Effect": "Allow",
+                        "Action": "rds:RestoreDBInstanceFromDBSnapshot",
+                        "Resource": "*",
+                        "Condition": {
+                            "StringEquals": {
+                                "rds:req-tag/RDS-sanitized-snapshots": "yes",
+                            }
                         }
-                    }
-                },
-                troposphere.If(
-                    "KmsEmpty",
-                    troposphere.NoValue,
+                    },
                     {
-                        "Sid": "Copy",
+                        "Sid": "TempDB",
                         "Effect": "Allow",
                         "Action": [
-                            "kms:CreateGrant",
-                            "kms:DescribeKey",
+                            "rds:CreateDBInstance",
+                            "rds:DeleteDBInstance",
+                            "rds:DescribeDBInstances",
+                            "rds:ModifyDBInstance",
+                            "rds:CreateDBSnapshot",
+                            "rds:DeleteDBSnapshot",
+                            "rds:ModifyDBSnapshotAttribute",
                         ],
-                        "Resource": troposphere.Ref("KMS"),
-                    }
-                ),
-            ]
-        }
-    )
-]
+                        "Resource": "*",
+                        "Condition": {
+                            "ForAllValues:StringEquals": {
+                                "aws:TagKeys": [
+                                    "RDS-sanitized-snapshots"
+                                ]
+                            }
+                        }
+                    },
+                    {
+                        "Sid": "Cleanup",
+                        "Effect": "Allow",
+                        "Action": "tag:GetResources",
+                        "Resource": "*",
+                        "Condition": {
+                            "ForAllValues:StringEquals": {
+                                "aws:TagKeys": [
+                                    "RDS-sanitized-snapshots-temp",
+                                ]
+                            }
+                        }
+                    },
+                    troposphere.If(
+                        "KmsEmpty",
+                        troposphere.NoValue,
+                        {
+                            "Sid": "Copy",
+                            "Effect": "Allow",
+                            "Action": [
+                                "kms:CreateGrant",
+                                "kms:DescribeKey",
+                            ],
+                            "Resource": troposphere.Ref("KMS"),
+                        }
+                    ),
+                ]
+            }
+        )
+    ]
 
 
 def add_lambda_role(template: troposphere.Template, name: str, policies: typing.Iterable[troposphere.iam.Policy]):
@@ -1,45 +1,99 @@
+import concurrent.futures
 import datetime
+import os
 import re
 import secrets
+import time
 
 import boto3
-
-rds_client = boto3.client("rds")
-res_client = boto3.client("resourcegroupstaggingapi")
+import botocore.config
+import botocore.exceptions
+
+# adaptive retries back off on throttled describe calls, the larger pool leaves room for concurrent cleanup
+# requests and keepalive stops idle connections from being dropped between invocations
+_client_config = botocore.config.Config(
+    retries={"mode": "adaptive", "max_attempts": 10},
+    max_pool_connections=32,
+    tcp_keepalive=True,
+)
+# both clients share one session's credentials, loader and endpoint resolver
+_session = boto3.session.Session()
+rds_client = _session.client("rds", config=_client_config)
+res_client = _session.client("resourcegroupstaggingapi", config=_client_config)
 states = {}
-
-
-class NotReady(Exception):
-    pass
+_BAD_STATUS_RE = re.compile("stop|delet|fail|incompatible|inaccessible|error")
+# wait up to ~5 minutes per invocation (within the function timeout) before handing back to the state machine
+_WAITER_CONFIG = {"Delay": 20, "MaxAttempts": 14}
+# give up on a waiting state that hasn't been ready for 5 hours
+_MAX_WAIT_SECONDS = 5 * 60 * 60
+# tag shared by everything we create, a tuple so no caller can append to it
+_TAGS_BASE = (
+    {
+        "Key": "RDS-sanitized-snapshots",
+        "Value": "yes",
+    },
+)
 
 
 def _tags(uid=None):
-    tags = [
+    if not uid:
+        return list(_TAGS_BASE)
+
+    return [
+        *_TAGS_BASE,
         {
-            "Key": "RDS-sanitized-snapshots",
-            "Value": "yes",
+            "Key": "RDS-sanitized-snapshots-temp",
+            "Value": uid,
         },
     ]
 
-    if uid:
-        tags.append(
-            {
-                "Key": "RDS-sanitized-snapshots-temp",
-                "Value": uid,
-            },
-        )
-
-    return tags
-
 
 def _check_status(s):
-    if "stop" in s or "delet" in s or "fail" in s or "incompatible" in s or "inaccessible" in s or "error" in s:
-        raise ValueError("Bad status `${s}`")
-
-
-def state_function(name):
+    if _BAD_STATUS_RE.search(s):
+        raise ValueError(f"Bad status {s!r}")
+
+
+def _valid_snapshot_id(sid):
+    # https://docs.aws.amazon.com/AmazonRDS/latest/UserGuide/CHAP_Limits.html
+    # starts with a letter, only letters, digits and single hyphens, no trailing hyphen, 2-63 characters
+    if not 2 <= len(sid) <= 63 or not (sid[0].isascii() and sid[0].isalpha()):
+        return False
+    prev_dash = False
+    for c in sid:
+        if c == "-":
+            if prev_dash:
+                return False
+            prev_dash = True
+        elif c.isascii() and c.isalnum():
+            prev_dash = False
+        else:
+            return False
+    return not prev_dash
+
+
+def _wait(waiter, **kwargs):
+    try:
+        rds_client.get_waiter(waiter).wait(WaiterConfig=_WAITER_CONFIG, **kwargs)
+        return True
+    except botocore.exceptions.WaiterError:
+        # timed out or hit a failure state, the status check that follows decides which
+        return False
+
+
+def _snapshot_exists(sid, instance):
+    # lets mutating states be retried without failing on snapshots an earlier attempt already created. only snapshots
+    # of the instance this execution snapshots count, so anything else with the same name still fails the create.
+    try:
+        snapshot = rds_client.describe_db_snapshots(DBSnapshotIdentifier=sid)["DBSnapshots"][0]
+    except rds_client.exceptions.DBSnapshotNotFoundFault:
+        return False
+    return snapshot["DBInstanceIdentifier"] == instance
+
+
+def state_function(*names):
     def decorator(f):
-        states[name] = f
+        for name in names:
+            states[name] = f
         return f
 
     return decorator
@@ -49,17 +103,18 @@ def state_function(name):
 def initialize(state, uid):
     orig_db = rds_client.describe_db_instances(DBInstanceIdentifier=state["db_identifier"])["DBInstances"][0]
     state["engine"] = orig_db["Engine"]
-    state["temp_snapshot_id"] = state["db_identifier"][:55] + "-" + secrets.token_hex(5)
-    state["temp_snapshot_id2"] = state["db_identifier"][:55] + "-" + secrets.token_hex(5)
-    state["temp_db_id"] = state["db_identifier"][:55] + "-" + secrets.token_hex(5)
-    state["target_snapshot_id"] = state["db_identifier"][:55] + "-" + secrets.token_hex(5)
+    # one random draw split into the same 10 hex characters per id that three token_hex(5) calls gave
+    rand = secrets.token_hex(15)
+    prefix = state["db_identifier"][:55]
+    state["temp_snapshot_id"] = f"{prefix}-{rand[:10]}"
+    state["temp_snapshot_id2"] = f"{prefix}-{rand[10:20]}"
+    state["temp_db_id"] = f"{prefix}-{rand[20:]}"
     tsid = state["target_snapshot_id"] = state["snapshot_format"].format(
         database_identifier=state["db_identifier"],
-        date=datetime.datetime.now(),
+        date=datetime.datetime.now(datetime.timezone.utc),
     )
 
-    if not re.match("[a-z][a-z0-9\\-]{1,62}", tsid, re.I) or "--" in tsid or tsid[-1] == "-":
-        # https://docs.aws.amazon.com/AmazonRDS/latest/UserGuide/CHAP_Limits.html
+    if not _valid_snapshot_id(tsid):
         raise ValueError(f"Invalid snapshot id generated from format - {tsid}")
 
     if state["kms"] and orig_db["DBInstanceClass"] in ["db.m1.small", "db.m1.medium", "db.m1.large", "db.m1.xlarge",
@@ -70,48 +125,50 @@ def initialize(state, uid):
 
 @state_function("FindLatestSnapshot")
 def find_latest_snapshot(state, uid):
-    db_identifier = state["db_identifier"]
-    snapshots = []
-    for page in rds_client.get_paginator("describe_db_snapshots").paginate(DBInstanceIdentifier=db_identifier):
-        for snapshot in page["DBSnapshots"]:
-            snapshots.append((snapshot["SnapshotCreateTime"], snapshot))
-
-    snapshots.sort()
-    state["snapshot_id"] = snapshots[-1][1]["DBSnapshotIdentifier"]
+    pages = rds_client.get_paginator("describe_db_snapshots").paginate(
+        DBInstanceIdentifier=state["db_identifier"],
+        PaginationConfig={"PageSize": 100},
+    )
+    latest = max((snapshot for page in pages for snapshot in page["DBSnapshots"]),
+                 key=lambda snapshot: snapshot["SnapshotCreateTime"])
+    state["snapshot_id"] = latest["DBSnapshotIdentifier"]
 
 
 @state_function("TakeSnapshot")
 def take_snapshot(state, uid):
     state["snapshot_id"] = state["temp_snapshot_id"]
 
-    rds_client.create_db_snapshot(
-        DBInstanceIdentifier=state["db_identifier"],
-        DBSnapshotIdentifier=state["snapshot_id"],
-        Tags=_tags(uid),
-    )
+    if not _snapshot_exists(state["snapshot_id"], state["db_identifier"]):
+        rds_client.create_db_snapshot(
+            DBInstanceIdentifier=state["db_identifier"],
+            DBSnapshotIdentifier=state["snapshot_id"],
+            Tags=_tags(uid),
+        )
 
 
 @state_function("TakeFinalSnapshot")
 def take_final_snapshot(state, uid):
     state["snapshot_id"] = state["target_snapshot_id"]
 
-    rds_client.create_db_snapshot(
-        DBInstanceIdentifier=state["temp_db_id"],
-        DBSnapshotIdentifier=state["snapshot_id"],
-        Tags=_tags(),
-    )
+    if not _snapshot_exists(state["snapshot_id"], state["temp_db_id"]):
+        rds_client.create_db_snapshot(
+            DBInstanceIdentifier=state["temp_db_id"],
+            DBSnapshotIdentifier=state["snapshot_id"],
+            Tags=_tags(),
+        )
 
 
-@state_function("WaitForSnapshot")
-@state_function("WaitForFinalSnapshot")
-@state_function("WaitForEncrypt")
+@state_function("WaitForSnapshot", "WaitForFinalSnapshot", "WaitForEncrypt")
 def wait_for_snapshot(state, uid):
+    if _wait("db_snapshot_available", DBSnapshotIdentifier=state["snapshot_id"]):
+        # the waiter's last poll already saw it available
+        return True
     snapshot = rds_client.describe_db_snapshots(DBSnapshotIdentifier=state["snapshot_id"])["DBSnapshots"][0]
     status = snapshot["Status"]
     if status == "available":
-        return
+        return True
     _check_status(status)
-    raise NotReady()
+    return False
 
 
 @state_function("Encrypt")
@@ -119,16 +176,24 @@ def encrypt(state, uid):
     old_snapshot_id = state["snapshot_id"]
     state["snapshot_id"] = state["temp_snapshot_id2"]
 
-    rds_client.copy_db_snapshot(
-        SourceDBSnapshotIdentifier=old_snapshot_id,
-        TargetDBSnapshotIdentifier=state["snapshot_id"],
-        KmsKeyId=state["kms"],
-        Tags=_tags(uid),
-    )
+    # copies keep the instance identifier of the snapshot they were copied from
+    if not _snapshot_exists(state["snapshot_id"], state["db_identifier"]):
+        rds_client.copy_db_snapshot(
+            SourceDBSnapshotIdentifier=old_snapshot_id,
+            TargetDBSnapshotIdentifier=state["snapshot_id"],
+            KmsKeyId=state["kms"],
+            Tags=_tags(uid),
+        )
 
 
 @state_function("CreateTempDatabase")
 def create_temp_database(state, uid):
+    try:
+        rds_client.describe_db_instances(DBInstanceIdentifier=state["temp_db_id"])
+        return  # already restored by an earlier attempt
+    except rds_client.exceptions.DBInstanceNotFoundFault:
+        pass
+
     rds_client.restore_db_instance_from_db_snapshot(
         DBInstanceIdentifier=state["temp_db_id"],
         DBSnapshotIdentifier=state["snapshot_id"],
@@ -142,27 +207,37 @@ def create_temp_database(state, uid):
     )
 
 
-@state_function("WaitForTempDatabase")
-@state_function("WaitForPassword")
+def _connection_details(db):
+    return {
+        "host": db["Endpoint"]["Address"],
+        "port": str(db["Endpoint"]["Port"]),
+        "user": db["MasterUsername"],
+        "database": db.get("DBName", ""),
+    }
+
+
+@state_function("WaitForTempDatabase", "WaitForPassword")
 def wait_for_temp_database(state, uid):
+    _wait("db_instance_available", DBInstanceIdentifier=state["temp_db_id"])
     db = rds_client.describe_db_instances(DBInstanceIdentifier=state["temp_db_id"])["DBInstances"][0]
     status = db["DBInstanceStatus"]
     if status == "available" and not db["PendingModifiedValues"]:
-        return
+        # remember connection details so SetTempPassword doesn't have to describe the database again
+        state.setdefault("db", _connection_details(db))
+        return True
     _check_status(status)
-    raise NotReady()
+    return False
 
 
 @state_function("SetTempPassword")
 def set_temp_password(state, uid):
-    db = rds_client.describe_db_instances(DBInstanceIdentifier=state["temp_db_id"])["DBInstances"][0]
-    state["db"] = {
-        "host": db["Endpoint"]["Address"],
-        "port": str(db["Endpoint"]["Port"]),
-        "user": db["MasterUsername"],
-        "password": secrets.token_hex(32),
-        "database": db.get("DBName", ""),
-    }
+    password = secrets.token_hex(32)
+
+    if "db" not in state:
+        # executions that passed WaitForTempDatabase before it started recording connection details
+        db = rds_client.describe_db_instances(DBInstanceIdentifier=state["temp_db_id"])["DBInstances"][0]
+        state["db"] = _connection_details(db)
+    state["db"]["password"] = password
 
     rds_client.modify_db_instance(
         DBInstanceIdentifier=state["temp_db_id"],
@@ -174,16 +249,26 @@ def set_temp_password(state, uid):
 
 @state_function("ShareSnapshot")
 def share_snapshot(state, uid):
-    if state["shared_accounts"]:
+    if not state["shared_accounts"]:
+        return
+
+    attributes = rds_client.describe_db_snapshot_attributes(
+        DBSnapshotIdentifier=state["snapshot_id"],
+    )["DBSnapshotAttributesResult"]["DBSnapshotAttributes"]
+    shared = {account for a in attributes if a["AttributeName"] == "restore" for account in a["AttributeValues"]}
+    missing = [account for account in state["shared_accounts"] if account not in shared]
+
+    if missing:
         rds_client.modify_db_snapshot_attribute(
             DBSnapshotIdentifier=state["snapshot_id"],
             AttributeName="restore",
-            ValuesToAdd=state["shared_accounts"]
+            ValuesToAdd=missing
         )
 
 
 def _ids(t, i):
-    return [x["ResourceARN"].split(":")[-1] for x in res_client.get_resources(
+    # get_resources only returns one page at a time, anything past it would be leaked
+    pages = res_client.get_paginator("get_resources").paginate(
         ResourceTypeFilters=[t],
         TagFilters=[
             {
@@ -191,35 +276,72 @@ def _ids(t, i):
                 "Values": [i]
             }
         ]
-    )["ResourceTagMappingList"]]
+    )
+    for page in pages:
+        for x in page["ResourceTagMappingList"]:
+            yield x["ResourceARN"].rpartition(":")[2]
+
 
+def _delete_db(db):
+    print(f"Deleting temporary database {db}")
+    rds_client.delete_db_instance(
+        DBInstanceIdentifier=db,
+        SkipFinalSnapshot=True,
+        DeleteAutomatedBackups=True,
+    )
+
+
+def _delete_snapshot(sid):
+    print(f"Deleting temporary snapshot {sid}")
+    rds_client.delete_db_snapshot(
+        DBSnapshotIdentifier=sid,
+    )
 
-@state_function("Cleanup")
-@state_function("ErrorCleanup")
+
+@state_function("Cleanup", "ErrorCleanup")
 def cleanup(state, uid):
     # we have to manually look for snapshots/dbs because error state doesn't pass parameters
 
-    for db in _ids("rds:db", uid):
-        print(f"Deleting temporary database {db}")
-        rds_client.delete_db_instance(
-            DBInstanceIdentifier=db,
-            SkipFinalSnapshot=True,
-            DeleteAutomatedBackups=True,
-        )
+    # every lookup and delete is an independent request, so issue them all at once and start deleting as soon as
+    # each page of ids arrives
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        def delete_all(t, delete):
+            return [executor.submit(delete, x) for x in _ids(t, uid)]
 
-    for sid in _ids("rds:snapshot", uid):
-        print(f"Deleting temporary snapshot {sid}")
-        rds_client.delete_db_snapshot(
-            DBSnapshotIdentifier=sid,
-        )
+        listings = [
+            executor.submit(delete_all, "rds:db", _delete_db),
+            executor.submit(delete_all, "rds:snapshot", _delete_snapshot),
+        ]
+        deletes = [delete for listing in listings for delete in listing.result()]
+
+    for delete in deletes:
+        # raise any failure so the state machine retries the whole cleanup
+        delete.result()
+
+
+# bound once so each invocation skips the attribute lookup
+_dispatch = states.get
 
 
 def handler(event, context):
-    print("event:", event)
+    # printing every event costs a repr of the whole state and the matching CloudWatch ingestion
+    if os.environ.get("DEBUG"):
+        print("event:", event)
 
     state_name = event["state_name"]
     state = event["state"]
 
-    states[state_name](state, event["uid"])
+    fn = _dispatch(state_name)
+    if fn is None:
+        raise KeyError(state_name)
+    ready = fn(state, event["uid"])
+
+    if ready is not None:
+        # waiting states tell the state machine whether to move on or poll again
+        state["ready"] = ready
+        if ready:
+            state.pop("wait_started", None)
+        elif time.time() - state.setdefault("wait_started", time.time()) > _MAX_WAIT_SECONDS:
+            raise TimeoutError(f"{state_name} not ready after {_MAX_WAIT_SECONDS} seconds")
 
     return state